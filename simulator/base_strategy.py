@@ -3,8 +3,7 @@ from collections import deque, defaultdict
 from typing import List, Optional, Tuple, Union, Dict, Deque
 
 from .simulator import Sim
-from .utils import get_mid_price, update_best_positions,\
-    MdUpdate, Order, OwnTrade, MdUpdate
+from .utils import get_mid_price, update_best_positions, Order, KIND_MD_UPDATE, KIND_OWN_TRADE
 
 
 class BaseStrategy:
@@ -91,7 +90,7 @@ class BaseStrategy:
                 go = False
 
             for md in updates:
-                assert isinstance(md, MdUpdate), "wrong update type!"
+                assert md.kind == KIND_MD_UPDATE, "wrong update type!"
 
                 self.lists['md'].append(md)
                 
@@ -172,16 +171,15 @@ class BaseStrategy:
             self.lists['update'] += updates
             
             for update in updates:
-                if isinstance(update, MdUpdate):
+                if update.kind == KIND_MD_UPDATE:
                     self.lists['md'].append(update)
                     self._update_md(update)
-                elif isinstance(update, OwnTrade):
+                elif update.kind == KIND_OWN_TRADE:
                     self.lists['trade'].append(update)
                     #delete executed trades from the dict
                     if update.order_id in ongoing_orders.keys():
                         ongoing_orders.pop(update.order_id)
-                    sgn = 1.0 if update.side == 'BID' else -1.0
-                    btc_pos += sgn * update.size
+                    btc_pos += update.side_sign * update.size
                 else: 
                     assert False, 'invalid type of update!'
             
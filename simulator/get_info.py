@@ -1,9 +1,11 @@
+from operator import attrgetter
 from typing import List, Union
 
 import numpy as np
 import pandas as pd
 
-from .simulator import MdUpdate, OwnTrade, update_best_positions
+from .simulator import MdUpdate, OwnTrade
+from .utils import MarketDataSoA, updates_to_arrays, accumulate_best_positions
 
 
 def get_metrics(updates_list: List[Union[MdUpdate, OwnTrade]], fee_maker, fee_taker) -> pd.DataFrame:
@@ -15,54 +17,27 @@ def get_metrics(updates_list: List[Union[MdUpdate, OwnTrade]], fee_maker, fee_ta
     Returns:
         Data frame with PnL and other metrics.
     """
-    base_pos, quote_pos = 0.0, 0.0  # current position in base and quote assets
-    # current trading volume in quote asset
-    volume_maker = 0.0
-    volume_taker = 0.0
-    N = len(updates_list)
-    base_pos_arr = np.zeros((N,))
-    quote_pos_arr = np.zeros((N,))
-    mid_price_arr = np.zeros((N,))
-    volume_maker_arr = np.zeros((N,))
-    volume_taker_arr = np.zeros((N,))
-    # current best_bid and best_ask
-    best_bid: float = -np.inf
-    best_ask: float = np.inf
-
-    for i, update in enumerate(updates_list):
-        if isinstance(update, MdUpdate):
-            best_bid, best_ask = update_best_positions(best_bid, best_ask, update)
-        # mid-price is used to calculate current portfolio value
-        mid_price = 0.5 * (best_ask + best_bid)
-
-        if isinstance(update, OwnTrade):
-            trade = update
-            if trade.type == 'MAKER':
-                volume_maker += trade.size
-            else:
-                volume_taker += trade.size
-            # update positions
-            if trade.side == 'BID':
-                base_pos += trade.size
-                quote_pos -= trade.price * trade.size
-            elif trade.side == 'ASK':
-                base_pos -= trade.size
-                quote_pos += trade.price * trade.size
-            # on Binance Futures, fees are deducted like this
-            fee = fee_maker if trade.type == 'MAKER' else fee_taker
-            quote_pos -= fee * trade.price * trade.size
-
-        base_pos_arr[i] = base_pos
-        volume_maker_arr[i] = volume_maker
-        volume_taker_arr[i] = volume_taker
-        quote_pos_arr[i] = quote_pos
-        mid_price_arr[i] = mid_price
+    arrays = updates_to_arrays(updates_list)
+    best_bid, best_ask = accumulate_best_positions(arrays)
+    # mid-price is used to calculate current portfolio value
+    mid_price_arr = 0.5 * (best_ask + best_bid)
+
+    is_maker = arrays["is_maker"]
+    side_sign = arrays["side_sign"]
+    size = arrays["trade_size"]
+    quote_size = arrays["trade_price"] * size
+    # current trading volume
+    volume_maker_arr = np.cumsum(np.where(is_maker, size, 0.0))
+    volume_taker_arr = np.cumsum(np.where(is_maker, 0.0, size))
+    # on Binance Futures, fees are deducted like this
+    fee = np.where(is_maker, fee_maker, fee_taker)
+    # current position in base and quote assets
+    base_pos_arr = np.cumsum(side_sign * size)
+    quote_pos_arr = np.cumsum(-side_sign * quote_size - fee * quote_size)
 
     worth_arr = base_pos_arr * mid_price_arr + quote_pos_arr
-    receive_ts = [update.receive_ts for update in updates_list]
-    exchange_ts = [update.exchange_ts for update in updates_list]
 
-    df = pd.DataFrame({"exchange_ts": exchange_ts, "receive_ts": receive_ts,
+    df = pd.DataFrame({"exchange_ts": arrays["exchange_ts"], "receive_ts": arrays["receive_ts"],
                        "worth_quote": worth_arr,
                        "volume_maker": volume_maker_arr,
                        "volume_taker": volume_taker_arr,
@@ -71,50 +46,35 @@ def get_metrics(updates_list: List[Union[MdUpdate, OwnTrade]], fee_maker, fee_ta
                        "mid_price": mid_price_arr})
     df['exchange_ts'] = pd.to_datetime(df['exchange_ts'])
     df['receive_ts'] = pd.to_datetime(df['receive_ts'])
-    df = df.reset_index().drop(columns=['index'])
     return df
 
 
 def trade_to_dataframe(trades_list: List[OwnTrade]) -> pd.DataFrame:
-    exchange_ts = [trade.exchange_ts for trade in trades_list]
-    receive_ts = [trade.receive_ts for trade in trades_list]
-
-    size = [trade.size for trade in trades_list]
-    price = [trade.price for trade in trades_list]
-    side = [trade.side for trade in trades_list]
-
-    dct = {
-        "exchange_ts": exchange_ts,
-        "receive_ts": receive_ts,
-        "size": size,
-        "price": price,
-        "side": side
-    }
+    fields = ("exchange_ts", "receive_ts", "size", "price", "side")
+    # single pass over the list, all the fields of a trade are fetched at once
+    columns = list(zip(*map(attrgetter(*fields), trades_list))) or [()] * len(fields)
+    dct = dict(zip(fields, columns))
 
     # df = pd.DataFrame(dct).groupby('receive_ts').agg(lambda x: x.iloc[-1]).reset_index()
     df = pd.DataFrame(dct)
+    df.side = df.side.astype('category')
     df.receive_ts = pd.to_datetime(df.receive_ts)
     df.exchange_ts = pd.to_datetime(df.exchange_ts)
     return df
 
 
-def md_to_dataframe(md_list: List[MdUpdate]) -> pd.DataFrame:
-    best_bid = -np.inf
-    best_ask = np.inf
-    best_bids = []
-    best_asks = []
-    for md in md_list:
-        best_bid, best_ask = update_best_positions(best_bid, best_ask, md)
-        best_bids.append(best_bid)
-        best_asks.append(best_ask)
+def md_to_dataframe(md_list: Union[List[MdUpdate], MarketDataSoA]) -> pd.DataFrame:
+    if isinstance(md_list, MarketDataSoA):
+        arrays = md_list.to_arrays()
+    else:
+        arrays = updates_to_arrays(md_list)
+    best_bid, best_ask = accumulate_best_positions(arrays)
 
-    exchange_ts = [md.exchange_ts for md in md_list]
-    receive_ts = [md.receive_ts for md in md_list]
     dct = {
-        "exchange_ts": exchange_ts,
-        "receive_ts": receive_ts,
-        "bid_price": best_bids,
-        "ask_price": best_asks
+        "exchange_ts": arrays["exchange_ts"],
+        "receive_ts": arrays["receive_ts"],
+        "bid_price": best_bid,
+        "ask_price": best_ask
     }
     # df = pd.DataFrame(dct).groupby('receive_ts').agg(lambda x: x.iloc[-1]).reset_index()
     df = pd.DataFrame(dct)
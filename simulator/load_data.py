@@ -1,36 +1,156 @@
+import hashlib
+import os
+from dataclasses import fields
+
+import numpy as np
 import pandas as pd
-from typing import List, Optional
-from .utils import AnonTrade, MdUpdate, OrderbookSnapshotUpdate
+from typing import Any, Dict, List, Optional
+from .utils import AnonTrade, MdUpdate, OrderbookSnapshotUpdate, MarketDataSoA, \
+    gc_paused, levels_to_tuples
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pacsv
+    from pyarrow import feather
+except ImportError:  # pyarrow is optional, pandas reader and npz cache are used instead
+    pacsv = None
+    feather = None
+
+# column dtypes of market data files. Orderbook columns are named like
+# `<instrument>_ask_price_<level>`, the instrument prefix is ignored.
+# Prices and volumes are kept in float64: float32 can't represent prices like
+# 20000.15 exactly, which changes the simulation results
+TS_DTYPES = {'receive_ts': np.int64, 'exchange_ts': np.int64}
+LOBS_DTYPES = {**TS_DTYPES, **{f"{side}_{field}_{i}": np.float64
+                               for i in range(10)
+                               for side in ('ask', 'bid')
+                               for field in ('price', 'vol')}}
+# categories of the side are fixed, otherwise each chunk of the file gets its own
+# categories and the chunks are concatenated to plain strings
+SIDE_DTYPE = pd.CategoricalDtype(['ASK', 'BID'])
+TRADES_DTYPES = {**TS_DTYPES, 'price': np.float64, 'size': np.float64, 'aggro_side': SIDE_DTYPE}
+# version of the market data cache format, should be increased when `MarketDataSoA`
+# or the parsing of market data is changed, so that old cache files are not used
+MD_CACHE_VERSION = 1
+
+
+def _column_dtypes(columns: pd.Index, dtypes: Dict[str, Any]) -> Dict[str, Any]:
+    """ Matches columns of the CSV file with `dtypes` """
+    res = {}
+    for name in columns:
+        key = name if name in dtypes else name[name.find('_') + 1:]
+        if key in dtypes:
+            res[name] = dtypes[key]
+    return res
+
+
+def _interval_mask(receive_ts: np.ndarray,
+                   min_ts: Optional[pd.Timestamp] = None,
+                   max_ts: Optional[pd.Timestamp] = None) -> np.ndarray:
+    """ Mask of the rows with `min_ts <= receive_ts <= max_ts` """
+    mask = np.ones(len(receive_ts), dtype=bool)
+    if min_ts is not None:
+        mask &= receive_ts >= min_ts.value
+    if max_ts is not None:
+        mask &= receive_ts <= max_ts.value
+    return mask
+
+
+def _read_csv_arrow(path: str, columns: pd.Index, dtypes: Dict[str, Any],
+                    min_ts: Optional[pd.Timestamp] = None,
+                    max_ts: Optional[pd.Timestamp] = None) -> pd.DataFrame:
+    """ Multi-threaded CSV reader, used if pyarrow is installed """
+    column_types = {name: pa.string() if dtype == 'category' else pa.from_numpy_dtype(dtype)
+                    for name, dtype in dtypes.items()}
+    reader = pacsv.open_csv(
+        path,
+        # column names are taken from pandas to strip spaces the same way
+        read_options=pacsv.ReadOptions(column_names=list(columns), skip_rows=1,
+                                       block_size=8 << 20, use_threads=True),
+        convert_options=pacsv.ConvertOptions(column_types=column_types,
+                                             include_columns=list(dtypes)))
+
+    batches = []
+    # the file is sorted by receive_ts, it is streamed by blocks and each
+    # block is filtered right away, so only the rows of the interval are kept
+    for batch in reader:
+        receive_ts = batch.column('receive_ts').to_numpy()
+        if len(receive_ts) == 0:
+            continue
+        if min_ts is not None and receive_ts[-1] < min_ts.value:
+            continue
+        if max_ts is not None and receive_ts[0] > max_ts.value:
+            break
+        mask = _interval_mask(receive_ts, min_ts, max_ts)
+        if mask.all():
+            batches.append(batch)
+        elif mask.any():
+            batches.append(batch.filter(pa.array(mask)))
+    table = pa.Table.from_batches(batches, schema=reader.schema)
+
+    for name, dtype in dtypes.items():
+        if dtype == 'category':
+            # numbers are parsed with leading spaces skipped, strings are not
+            column = pc.utf8_ltrim_whitespace(table[name]).dictionary_encode()
+            table = table.set_column(table.schema.get_field_index(name), name, column)
+    df = table.to_pandas(self_destruct=True, split_blocks=True)
+    del table, batches
+    pa.default_memory_pool().release_unused()
+    for name, dtype in dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            # same categories as with the pandas reader
+            df[name] = df[name].astype(dtype)
+    return df
 
 
 def load_md_interval(path: str,
                      min_ts: Optional[pd.Timestamp] = None,
-                     max_ts: Optional[pd.Timestamp] = None) -> pd.DataFrame:
+                     max_ts: Optional[pd.Timestamp] = None,
+                     dtypes: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
+    """ Loads CSV file, if `dtypes` is provided, only matching columns are loaded """
+    read_kwargs = dict(skipinitialspace=True, engine='c')
+    if dtypes is not None:
+        columns = pd.read_csv(path, nrows=0, skipinitialspace=True).columns
+        dtypes = _column_dtypes(columns, dtypes)
+        if pacsv is not None:
+            return _read_csv_arrow(path, columns, dtypes, min_ts, max_ts)
+        read_kwargs.update(dtype=dtypes, usecols=list(dtypes))
+    else:
+        # column types are inferred from the whole file, not from each block
+        read_kwargs.update(low_memory=False)
+
     if min_ts is None and max_ts is None:
-        df = pd.read_csv(path, skipinitialspace=True)
+        df = pd.read_csv(path, **read_kwargs)
     else:
         chunksize = 100_000
         chunks = []
-        for chunk in pd.read_csv(path, chunksize=chunksize, skipinitialspace=True):
-            if min_ts is not None and chunk['receive_ts'].iloc[-1] < min_ts.value:
-                pass
-            if max_ts is not None and chunk['receive_ts'].iloc[0] > max_ts.value:
+        # the file is sorted by receive_ts, each chunk is filtered right away,
+        # so only the rows of the interval are kept in memory
+        for chunk in pd.read_csv(path, chunksize=chunksize, **read_kwargs):
+            receive_ts = chunk['receive_ts'].to_numpy()
+            if min_ts is not None and receive_ts[-1] < min_ts.value:
+                continue
+            if max_ts is not None and receive_ts[0] > max_ts.value:
                 break
-            chunks.append(chunk)
-        df = pd.concat(chunks)
-        if min_ts is not None:
-            mask = df['receive_ts'] >= min_ts.value
-            df = df.loc[mask]
-        if max_ts is not None:
-            mask = df['receive_ts'] <= max_ts.value
-            df = df.loc[mask]
+            mask = _interval_mask(receive_ts, min_ts, max_ts)
+            if mask.all():
+                chunks.append(chunk)
+            elif mask.any():
+                chunks.append(chunk.loc[mask])
+        if len(chunks) == 1:
+            df = chunks[0].reset_index(drop=True)
+        elif chunks:
+            df = pd.concat(chunks, ignore_index=True)
+        else:
+            df = pd.read_csv(path, nrows=0, **read_kwargs)
     return df
 
 
 def load_trades(path: str,
                 min_ts: Optional[pd.Timestamp] = None,
                 max_ts: Optional[pd.Timestamp] = None) -> List[AnonTrade]:
-    trades = load_md_interval(path, min_ts, max_ts)
+    trades = load_md_interval(path, min_ts, max_ts, TRADES_DTYPES)
     # permute the columns to pass parameters to AnonTrade constructor
     trades = trades[
         ['exchange_ts', 'receive_ts', 'aggro_side', 'size', 'price']
@@ -39,50 +159,246 @@ def load_trades(path: str,
     return trades
 
 
-def load_books(path: str,
-               min_ts: Optional[pd.Timestamp] = None,
-               max_ts: Optional[pd.Timestamp] = None) -> List[OrderbookSnapshotUpdate]:
-    lobs = load_md_interval(path, min_ts, max_ts)
+def _side_sign(side: pd.Series) -> np.ndarray:
+    """ Converts `aggro_side` column of `category` dtype to 1 for BID, -1 for ASK, 0 otherwise """
+    categories = side.cat.categories
+    # the last element is used for missing values with code -1
+    signs = np.zeros(len(categories) + 1, dtype=np.int8)
+    signs[:-1][categories == 'BID'] = 1
+    signs[:-1][categories == 'ASK'] = -1
+    return signs[side.cat.codes.to_numpy()]
+
 
-    # rename columns
+def _rename_lobs_columns(lobs: pd.DataFrame) -> pd.DataFrame:
+    """ Strips instrument name from `<instrument>_ask_price_<level>` columns """
     new_names = {}
     for name in lobs.columns[2:]:
         new_names[name] = name[name.find('_') + 1:]
-    lobs.rename(columns=new_names, inplace=True)
+    return lobs.rename(columns=new_names)
+
+
+def _stack_levels(lobs: pd.DataFrame, field: str, levels: int = 10) -> np.ndarray:
+    """ Stacks `field` (e.g. `ask_price`) of all levels, shape: (len(lobs), levels) """
+    return np.stack([lobs[f"{field}_{i}"].to_numpy(np.float64) for i in range(levels)], axis=1)
+
+
+def load_books(path: str,
+               min_ts: Optional[pd.Timestamp] = None,
+               max_ts: Optional[pd.Timestamp] = None) -> List[OrderbookSnapshotUpdate]:
+    lobs = _rename_lobs_columns(load_md_interval(path, min_ts, max_ts, LOBS_DTYPES))
 
     # timestamps
     receive_ts = lobs.receive_ts.values
     exchange_ts = lobs.exchange_ts.values
-    # list of `ask_price`, `ask_vol` for different order book levels
-    # shapes: len(asks) = 10, len(asks[0]) = len(lobs)
-    asks = [list(zip(lobs[f"ask_price_{i}"], lobs[f"ask_vol_{i}"])) for i in range(10)]
-    # transpose the list
-    asks = [[asks[i][j] for i in range(len(asks))] for j in range(len(asks[0]))]
-    # same for bids
-    bids = [list(zip(lobs[f"bid_price_{i}"], lobs[f"bid_vol_{i}"])) for i in range(10)]
-    bids = [[bids[i][j] for i in range(len(bids))] for j in range(len(bids[0]))]
-
-    books = list(OrderbookSnapshotUpdate(*args) for args in zip(exchange_ts, receive_ts, asks, bids))
+    with gc_paused():
+        # `(price, vol)` pairs for different order book levels
+        asks = levels_to_tuples(_stack_levels(lobs, 'ask_price'), _stack_levels(lobs, 'ask_vol'))
+        bids = levels_to_tuples(_stack_levels(lobs, 'bid_price'), _stack_levels(lobs, 'bid_vol'))
+
+        books = list(OrderbookSnapshotUpdate(*args) for args in zip(exchange_ts, receive_ts, asks, bids))
     return books
 
 
+def _merge_rows(books_exchange_ts: np.ndarray, books_receive_ts: np.ndarray,
+                trades_exchange_ts: np.ndarray, trades_receive_ts: np.ndarray):
+    """ Merges timestamps of orderbook snapshots and trades into ticks.
+
+        Returns:
+            exchange_ts, receive_ts: timestamps of the ticks
+            book_row, trade_row: index of the book (trade) for each tick, -1 if there is none
+    """
+    n_books = len(books_exchange_ts)
+    exchange_ts = np.concatenate([books_exchange_ts, trades_exchange_ts]).astype(np.int64)
+    receive_ts = np.concatenate([books_receive_ts, trades_receive_ts]).astype(np.int64)
+
+    # for sorting, give receive_ts higher priority, because this is the order
+    # in which we receive market data when running the strategy in real-time.
+    # lexsort is stable: rows with equal timestamps keep their order, books first
+    order = np.lexsort((exchange_ts, receive_ts))
+    exchange_ts, receive_ts = exchange_ts[order], receive_ts[order]
+    is_book = order < n_books
+
+    # rows with equal timestamps are fused into one tick
+    new_tick = np.ones(len(order), dtype=bool)
+    new_tick[1:] = (exchange_ts[1:] != exchange_ts[:-1]) | (receive_ts[1:] != receive_ts[:-1])
+    tick = np.cumsum(new_tick) - 1
+    # if there are several books (trades) for a tick, the last one is used
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = new_tick[1:] | (is_book[1:] != is_book[:-1])
+
+    N = int(new_tick.sum())
+    book_row = np.full(N, -1)
+    book_row[tick[is_book & last]] = order[is_book & last]
+    trade_row = np.full(N, -1)
+    trade_row[tick[~is_book & last]] = order[~is_book & last] - n_books
+    return exchange_ts[new_tick], receive_ts[new_tick], book_row, trade_row
+
+
 def merge_books_and_trades(books: List[OrderbookSnapshotUpdate],
                            trades: List[AnonTrade]) -> List[MdUpdate]:
     """ This function merges lists of orderbook snapshots and trades """
-    trades_dict = {(trade.exchange_ts, trade.receive_ts): trade for trade in trades}
-    books_dict = {(book.exchange_ts, book.receive_ts): book for book in books}
+    exchange_ts, receive_ts, book_row, trade_row = _merge_rows(
+        np.fromiter((book.exchange_ts for book in books), dtype=np.int64, count=len(books)),
+        np.fromiter((book.receive_ts for book in books), dtype=np.int64, count=len(books)),
+        np.fromiter((trade.exchange_ts for trade in trades), dtype=np.int64, count=len(trades)),
+        np.fromiter((trade.receive_ts for trade in trades), dtype=np.int64, count=len(trades)))
 
-    # for sorting, give receive_ts higher priority, because this is the order
-    # in which we receive market data when running the strategy in real-time
-    ts = sorted(trades_dict.keys() | books_dict.keys(), key=lambda x: (x[1], x[0]))
+    md = [MdUpdate(ex, rx,
+                   books[i] if i >= 0 else None,
+                   trades[j] if j >= 0 else None)
+          for ex, rx, i, j in zip(exchange_ts.tolist(), receive_ts.tolist(),
+                                  book_row.tolist(), trade_row.tolist())]
+    return md
+
+
+def load_trades_arrays(path: str,
+                       min_ts: Optional[pd.Timestamp] = None,
+                       max_ts: Optional[pd.Timestamp] = None) -> MarketDataSoA:
+    trades = load_md_interval(path, min_ts, max_ts, TRADES_DTYPES)
+    # only the categories are compared with strings, not every row
+    trade_side = _side_sign(trades['aggro_side'])
+    assert np.all(trade_side != 0), "WRONG TRADE SIDE"
+
+    N = len(trades)
+    no_book = np.full((N, 0), np.nan)
+    return MarketDataSoA(
+        exchange_ts=trades['exchange_ts'].to_numpy(np.int64),
+        receive_ts=trades['receive_ts'].to_numpy(np.int64),
+        has_book=np.zeros(N, dtype=bool),
+        ask_price=no_book, ask_vol=no_book, bid_price=no_book, bid_vol=no_book,
+        trade_side=trade_side,
+        trade_size=trades['size'].to_numpy(np.float64),
+        trade_price=trades['price'].to_numpy(np.float64))
+
+
+def load_books_arrays(path: str,
+                      min_ts: Optional[pd.Timestamp] = None,
+                      max_ts: Optional[pd.Timestamp] = None) -> MarketDataSoA:
+    lobs = _rename_lobs_columns(load_md_interval(path, min_ts, max_ts, LOBS_DTYPES))
+
+    N = len(lobs)
+    return MarketDataSoA(
+        exchange_ts=lobs['exchange_ts'].to_numpy(np.int64),
+        receive_ts=lobs['receive_ts'].to_numpy(np.int64),
+        has_book=np.ones(N, dtype=bool),
+        ask_price=_stack_levels(lobs, 'ask_price'), ask_vol=_stack_levels(lobs, 'ask_vol'),
+        bid_price=_stack_levels(lobs, 'bid_price'), bid_vol=_stack_levels(lobs, 'bid_vol'),
+        trade_side=np.zeros(N, dtype=np.int8),
+        trade_size=np.full(N, np.nan),
+        trade_price=np.full(N, np.nan))
+
+
+def merge_md_arrays(books: MarketDataSoA, trades: MarketDataSoA) -> MarketDataSoA:
+    """ Same as `merge_books_and_trades`, but for market data stored as arrays.
+        `books` should contain only orderbook snapshots and `trades` only trades.
+    """
+    exchange_ts, receive_ts, book_row, trade_row = _merge_rows(
+        books.exchange_ts, books.receive_ts, trades.exchange_ts, trades.receive_ts)
+    N = len(exchange_ts)
+    has_book = book_row >= 0
+    has_trade = trade_row >= 0
+
+    def take(values: np.ndarray, rows: np.ndarray, mask: np.ndarray, fill) -> np.ndarray:
+        res = np.full((N,) + values.shape[1:], fill, dtype=values.dtype)
+        res[mask] = values[rows[mask]]
+        return res
+
+    return MarketDataSoA(
+        exchange_ts=exchange_ts,
+        receive_ts=receive_ts,
+        has_book=has_book,
+        ask_price=take(books.ask_price, book_row, has_book, np.nan),
+        ask_vol=take(books.ask_vol, book_row, has_book, np.nan),
+        bid_price=take(books.bid_price, book_row, has_book, np.nan),
+        bid_vol=take(books.bid_vol, book_row, has_book, np.nan),
+        trade_side=take(trades.trade_side, trade_row, has_trade, 0),
+        trade_size=take(trades.trade_size, trade_row, has_trade, np.nan),
+        trade_price=take(trades.trade_price, trade_row, has_trade, np.nan))
+
+
+def _md_cache_path(cache_dir: str, lobs_path: str, trades_path: str,
+                   min_ts: Optional[pd.Timestamp] = None,
+                   max_ts: Optional[pd.Timestamp] = None) -> str:
+    """ Path of the cached market data, the cache is invalidated if any of the files is modified """
+    key = (MD_CACHE_VERSION,
+           os.path.abspath(lobs_path), os.path.getmtime(lobs_path),
+           os.path.abspath(trades_path), os.path.getmtime(trades_path),
+           None if min_ts is None else min_ts.value,
+           None if max_ts is None else max_ts.value)
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()
+    return os.path.join(cache_dir, f"md_{digest}" + (".feather" if feather is not None else ".npz"))
+
+
+def _write_md_cache(path: str, md: MarketDataSoA) -> None:
+    """ Writes market data to Feather file (or npz if pyarrow is not installed) """
+    columns = {}
+    for f in fields(MarketDataSoA):
+        values = getattr(md, f.name)
+        if values.ndim == 1:
+            columns[f.name] = values
+        else:
+            # orderbook levels are stored as separate columns
+            for i in range(values.shape[1]):
+                columns[f"{f.name}_{i}"] = values[:, i]
+    # the file is renamed when complete, so an interrupted write doesn't leave a broken cache
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if feather is not None:
+        feather.write_feather(pa.table(columns), tmp_path, compression='lz4')
+    else:
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, **columns)
+    os.replace(tmp_path, path)
+
+
+def _read_md_cache(path: str) -> MarketDataSoA:
+    """ Reads market data written by `_write_md_cache` """
+    if feather is not None:
+        table = feather.read_table(path, memory_map=True)
+        columns = {name: table.column(name).to_numpy() for name in table.column_names}
+    else:
+        with np.load(path) as file:
+            columns = dict(file)
+
+    values = {}
+    for f in fields(MarketDataSoA):
+        if f.name in columns:
+            values[f.name] = columns[f.name]
+        else:
+            levels = [columns[name] for name in columns if name.startswith(f"{f.name}_")]
+            if levels:
+                values[f.name] = np.stack(levels, axis=1)
+            else:
+                values[f.name] = np.full((len(columns['exchange_ts']), 0), np.nan)
+    return MarketDataSoA(**values)
+
+
+def load_md_arrays(lobs_path: str, trades_path: str,
+                   min_ts: Optional[pd.Timestamp] = None,
+                   max_ts: Optional[pd.Timestamp] = None,
+                   cache_dir: Optional[str] = None) -> MarketDataSoA:
+    """Same as `load_md_from_file`, but returns market data stored as arrays.
+        With `cache_dir`, the arrays are read from the cache without building any
+        python objects, so this is the fast path for repeated loads.
+    """
+    if cache_dir is not None:
+        cache_path = _md_cache_path(cache_dir, lobs_path, trades_path, min_ts, max_ts)
+        if os.path.exists(cache_path):
+            return _read_md_cache(cache_path)
+
+    books = load_books_arrays(lobs_path, min_ts, max_ts)
+    trades = load_trades_arrays(trades_path, min_ts, max_ts)
+    md = merge_md_arrays(books, trades)
 
-    md = [MdUpdate(*key, books_dict.get(key, None), trades_dict.get(key, None)) for key in ts]
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        _write_md_cache(cache_path, md)
     return md
 
 
 def load_md_from_file(lobs_path: str, trades_path: str,
                       min_ts: Optional[pd.Timestamp] = None,
-                      max_ts: Optional[pd.Timestamp] = None) -> List[MdUpdate]:
+                      max_ts: Optional[pd.Timestamp] = None,
+                      cache_dir: Optional[str] = None) -> List[MdUpdate]:
     """Load market data from specified time interval.
 
     Args:
@@ -96,10 +412,14 @@ def load_md_from_file(lobs_path: str, trades_path: str,
         max_ts:
             If provided, market data with reception timestamps greater
             than `max_ts` will not be included in resulting data frame.
+        cache_dir:
+            If provided, parsed market data is cached in this directory
+            and loaded from the cache when the function is called again
+            with the same files and time interval. `MdUpdate` objects
+            are still built from the cached data, use `load_md_arrays`
+            to skip that as well.
 
     Returns:
-        A data frame with market data.
+        A list with market data.
     """
-    books = load_books(lobs_path, min_ts, max_ts)
-    trades = load_trades(trades_path, min_ts, max_ts)
-    return merge_books_and_trades(books, trades)
+    return load_md_arrays(lobs_path, trades_path, min_ts, max_ts, cache_dir).to_md_updates()
@@ -4,16 +4,109 @@ from tqdm.auto import tqdm
 
 import numpy as np
 
-from .utils import Order, CancelOrder, OwnTrade, MdUpdate, \
-    update_best_positions, PriorQueue
+from .utils import Order, CancelOrder, OwnTrade, MdUpdate, MarketDataSoA, \
+    KIND_ORDER, KIND_CANCEL_ORDER, update_best_positions, updates_to_arrays, \
+    accumulate_best_positions, PriorQueue
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:  # numba is optional, vectorized numpy matching is used instead
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+# initial number of slots for orders waiting for execution
+ORDERS_CAPACITY = 1024
+# number of market data updates between progress bar updates
+PROGRESS_STEP = 10_000
+# how the order was executed
+EXECUTE_BOOK = 0
+EXECUTE_TRADE = 1
+EXECUTE_NAMES = ('BOOK', 'TRADE')
+
+
+@njit(cache=True)
+def _match_orders_loop(side: np.ndarray, price: np.ndarray, active: np.ndarray, count: int,
+                       best_bid: float, best_ask: float, trade_bid: float, trade_ask: float,
+                       executed_slots: np.ndarray, executed_how: np.ndarray) -> Tuple[int, float, float]:
+    """Matches active orders against current best positions and last trade.
+        Args:
+            side(np.ndarray): +1 for BID orders, -1 for ASK orders
+            price(np.ndarray): order prices
+            active(np.ndarray): mask of active slots, executed slots are deactivated
+            count(int): number of slots ever used
+            best_bid, best_ask(float): current best positions
+            trade_bid, trade_ask(float): prices of the last BID and ASK trades
+            executed_slots(np.ndarray): output, slots of executed orders
+            executed_how(np.ndarray): output, EXECUTE_BOOK or EXECUTE_TRADE
+        Returns:
+            number of executed orders, max price of the remaining BID orders
+            and min price of the remaining ASK orders
+    """
+    n_executed = 0
+    bid_bound, ask_bound = -np.inf, np.inf
+    for i in range(count):
+        if not active[i]:
+            continue
+        # order crosses the price if it is better than the price on the opposite side
+        sign = side[i]
+        if sign * (price[i] - (best_ask if sign == 1 else best_bid)) > 0:
+            executed_how[n_executed] = EXECUTE_BOOK
+        elif sign * (price[i] - (trade_ask if sign == 1 else trade_bid)) > 0:
+            executed_how[n_executed] = EXECUTE_TRADE
+        else:
+            if sign == 1:
+                bid_bound = max(bid_bound, price[i])
+            else:
+                ask_bound = min(ask_bound, price[i])
+            continue
+        active[i] = False
+        executed_slots[n_executed] = i
+        n_executed += 1
+    return n_executed, bid_bound, ask_bound
+
+
+def _match_orders_numpy(side: np.ndarray, price: np.ndarray, active: np.ndarray, count: int,
+                        best_bid: float, best_ask: float, trade_bid: float, trade_ask: float,
+                        executed_slots: np.ndarray, executed_how: np.ndarray) -> Tuple[int, float, float]:
+    """Same as `_match_orders_loop`, but with vectorized compares."""
+    side = side[:count]
+    price = price[:count]
+    is_bid = side == 1
+    by_book = side * (price - np.where(is_bid, best_ask, best_bid)) > 0
+    by_trade = side * (price - np.where(is_bid, trade_ask, trade_bid)) > 0
+    executed = active[:count] & (by_book | by_trade)
+
+    slots = np.flatnonzero(executed)
+    n_executed = len(slots)
+    active[slots] = False
+    executed_slots[:n_executed] = slots
+    executed_how[:n_executed] = np.where(by_book[slots], EXECUTE_BOOK, EXECUTE_TRADE)
+
+    resting = active[:count]
+    bid_prices = price[resting & is_bid]
+    ask_prices = price[resting & ~is_bid]
+    bid_bound = float(bid_prices.max()) if len(bid_prices) else -np.inf
+    ask_bound = float(ask_prices.min()) if len(ask_prices) else np.inf
+    return n_executed, bid_bound, ask_bound
+
+
+# the compiled loop needs no temporary arrays, without numba vectorized
+# compares are much faster than the python loop
+_match_orders = _match_orders_loop if HAS_NUMBA else _match_orders_numpy
 
 
 class Sim:
-    def __init__(self, market_data: List[MdUpdate], execution_latency: float,
+    def __init__(self, market_data: Union[List[MdUpdate], MarketDataSoA], execution_latency: float,
                  md_latency: float, show_progress: bool = True) -> None:
         """Exchange simulator.
             Args:
-                market_data(List[MdUpdate]): market data
+                market_data(Union[List[MdUpdate], MarketDataSoA]): market data
                 execution_latency(float): latency in nanoseconds
                 md_latency(float): latency in nanoseconds
                 show_progress(bool): whether to display progress bar
@@ -21,14 +114,49 @@ class Sim:
         # TODO: add parameter to indicate whether our orders shold be
         #       last or first in queue on the level (whichever is less
         #       optimistic for specific strategy)
-        # transform md to queue
-        self.md_queue = deque(market_data)
+        if isinstance(market_data, MarketDataSoA):
+            md_arrays = market_data.to_arrays()
+            market_data = market_data.to_md_updates()
+        else:
+            md_arrays = updates_to_arrays(market_data)
+        md_best_bid, md_best_ask = accumulate_best_positions(md_arrays)
+        # market data is walked with a cursor, the fields used by the tick loop
+        # are extracted once. They are kept as python lists, because reading
+        # numpy scalars in a python loop is slower
+        self.md_list = list(market_data)
+        self.md_cursor = 0
+        self.md_exchange_ts = md_arrays['exchange_ts'].tolist()
+        self.md_receive_ts = md_arrays['receive_ts'].tolist()
+        # best positions after each md update
+        self.md_best_bid = md_best_bid.tolist()
+        self.md_best_ask = md_best_ask.tolist()
+        # side (1 for BID, -1 for ASK, 0 for no trade) and price of the trade
+        self.md_trade_side = md_arrays['md_trade_side'].tolist()
+        self.md_trade_price = md_arrays['md_trade_price'].tolist()
         # action queue
         self.actions_queue: Deque[Union[Order, CancelOrder]] = deque()
         # SordetDict: receive_ts -> [updates]
         self.strategy_updates_queue = PriorQueue()
+        # orders waiting for execution are stored in arrays matched by `_match_orders`
+        self._orders: List[Optional[Order]] = [None] * ORDERS_CAPACITY
+        self._orders_side = np.zeros(ORDERS_CAPACITY, dtype=np.int8)
+        self._orders_price = np.zeros(ORDERS_CAPACITY)
+        self._orders_active = np.zeros(ORDERS_CAPACITY, dtype=bool)
+        # number of slots ever used and slots freed after that
+        self._orders_count = 0
+        self._free_slots: List[int] = []
+        # output buffers of `_match_orders`
+        self._executed_slots = np.zeros(ORDERS_CAPACITY, dtype=np.int64)
+        self._executed_how = np.zeros(ORDERS_CAPACITY, dtype=np.int8)
+        # max price of resting BID orders and min price of resting ASK orders.
+        # Canceled orders are not taken into account until the next matching,
+        # so the bounds may be looser than the actual prices, but never tighter
+        self._bid_bound = -np.inf
+        self._ask_bound = np.inf
         # map : order_id -> Order
         self.ready_to_execute_orders: Dict[int, Order] = {}
+        # map : order_id -> slot of the order in the order arrays
+        self._order_slots: Dict[int, int] = {}
 
         # current md
         self.md: Optional[MdUpdate] = None
@@ -41,23 +169,31 @@ class Sim:
         # current bid and ask
         self.best_bid = -np.inf
         self.best_ask = np.inf
-        # current trade
-        self.trade_price = {'BID': -np.inf, 'ASK': np.inf}
         # last order
         self.last_order: Optional[Order] = None
 
         if show_progress:
-            self.progress_bar = tqdm(total=len(self.md_queue))
+            self.progress_bar = tqdm(total=len(self.md_list), mininterval=0.5)
         else:
             self.progress_bar = None
 
-    def get_md_queue_event_time(self) -> np.float:
-        return np.inf if len(self.md_queue) == 0 else self.md_queue[0].exchange_ts
+    def update_progress(self) -> None:
+        """
+            Moves the progress bar to the current market data position.
+            The bar is updated in batches of `PROGRESS_STEP` updates, because
+            each call of `tqdm.update` is expensive compared to a tick.
+        """
+        done = self.md_cursor - self.progress_bar.n
+        if done >= PROGRESS_STEP or (done > 0 and self.md_cursor == len(self.md_exchange_ts)):
+            self.progress_bar.update(done)
 
-    def get_actions_queue_event_time(self) -> np.float:
+    def get_md_queue_event_time(self) -> float:
+        return self.md_exchange_ts[self.md_cursor] if self.md_cursor < len(self.md_exchange_ts) else np.inf
+
+    def get_actions_queue_event_time(self) -> float:
         return np.inf if len(self.actions_queue) == 0 else self.actions_queue[0].exchange_ts
 
-    def get_strategy_updates_queue_event_time(self) -> np.float:
+    def get_strategy_updates_queue_event_time(self) -> float:
         return self.strategy_updates_queue.min_key()
 
     def get_order_id(self) -> int:
@@ -70,36 +206,81 @@ class Sim:
         self.trade_id += 1
         return res
 
-    def update_last_trade(self) -> None:
-        assert self.md is not None, "no current market data!"
-        if self.md.trade is not None:
-            self.trade_price[self.md.trade.side] = self.md.trade.price
-
-    def delete_last_trade(self) -> None:
-        self.trade_price['BID'] = -np.inf
-        self.trade_price['ASK'] = np.inf
+    def get_last_trade(self) -> Tuple[float, float]:
+        """
+            Prices of BID and ASK trades of the current market data update.
+            Only the trade of the update processed on this tick is used, so
+            prices of the older trades don't have to be reset.
+        """
+        i = self.md_cursor - 1
+        side = self.md_trade_side[i]
+        trade_bid = self.md_trade_price[i] if side == 1 else -np.inf
+        trade_ask = self.md_trade_price[i] if side == -1 else np.inf
+        return trade_bid, trade_ask
+
+    def add_ready_order(self, order: Order) -> None:
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            if self._orders_count == len(self._orders):
+                self.grow_orders()
+            slot = self._orders_count
+            self._orders_count += 1
+        self._orders[slot] = order
+        self._orders_side[slot] = order.side_sign
+        self._orders_price[slot] = order.price
+        self._orders_active[slot] = True
+        self.ready_to_execute_orders[order.order_id] = order
+        self._order_slots[order.order_id] = slot
+        if order.side_sign == 1:
+            self._bid_bound = max(self._bid_bound, order.price)
+        else:
+            self._ask_bound = min(self._ask_bound, order.price)
+
+    def remove_ready_order(self, order_id: int) -> Optional[Order]:
+        order = self.ready_to_execute_orders.pop(order_id, None)
+        if order is None:
+            return None
+        slot = self._order_slots.pop(order_id)
+        self._orders[slot] = None
+        self._orders_active[slot] = False
+        self._free_slots.append(slot)
+        return order
 
-    def update_md(self, md: MdUpdate) -> None:
+    def grow_orders(self) -> None:
+        """
+            Doubles the capacity of the order arrays.
+        """
+        capacity = len(self._orders)
+        self._orders += [None] * capacity
+        self._orders_side = np.concatenate([self._orders_side, np.zeros(capacity, dtype=np.int8)])
+        self._orders_price = np.concatenate([self._orders_price, np.zeros(capacity)])
+        self._orders_active = np.concatenate([self._orders_active, np.zeros(capacity, dtype=bool)])
+        self._executed_slots = np.zeros(2 * capacity, dtype=np.int64)
+        self._executed_how = np.zeros(2 * capacity, dtype=np.int8)
+
+    def update_md(self) -> None:
+        i = self.md_cursor
+        self.md_cursor += 1
         # current orderbook
-        self.md = md
+        self.md = self.md_list[i]
         # update position
-        self.best_bid, self.best_ask = update_best_positions(self.best_bid, self.best_ask, md)
-        # update info about last trade
-        self.update_last_trade()
+        self.best_bid = self.md_best_bid[i]
+        self.best_ask = self.md_best_ask[i]
 
         # add md to strategy_updates_queue
-        self.strategy_updates_queue.push(md.receive_ts, md)
+        self.strategy_updates_queue.push(self.md_receive_ts[i], self.md)
 
     def update_action(self, action: Union[Order, CancelOrder]) -> None:
 
-        if isinstance(action, Order):
+        kind = action.kind
+        if kind == KIND_ORDER:
             # self.ready_to_execute_orders[action.order_id] = action
             # save last order to try to execute it aggressively
             self.last_order = action
-        elif isinstance(action, CancelOrder):
+        elif kind == KIND_CANCEL_ORDER:
             # cancel order
-            if action.id_to_delete in self.ready_to_execute_orders:
-                self.ready_to_execute_orders.pop(action.id_to_delete)
+            self.remove_ready_order(action.id_to_delete)
         else:
             assert False, "Wrong action type!"
 
@@ -125,21 +306,24 @@ class Sim:
             if strategy_updates_queue_et < min(md_queue_et, actions_queue_et):
                 break
 
+            # no actions and no orders to execute: just pass market data to the strategy
+            if actions_queue_et == np.inf and not self.ready_to_execute_orders:
+                self.update_md()
+                continue
+
             call_execute = md_queue_et <= actions_queue_et
             if md_queue_et <= actions_queue_et:
-                self.update_md(self.md_queue.popleft())
-                if self.progress_bar is not None:
-                    self.progress_bar.update(1)
+                self.update_md()
             if actions_queue_et <= md_queue_et:
                 self.update_action(self.actions_queue.popleft())
                 # execute last order aggressively
                 self.execute_last_order()
 
             # execute orders with current orderbook
-            if call_execute:
+            if call_execute and self.ready_to_execute_orders:
                 self.execute_orders()
-            # delete last trade
-            self.delete_last_trade()
+        if self.progress_bar is not None:
+            self.update_progress()
         key, res = self.strategy_updates_queue.pop()
         return key, res
 
@@ -151,14 +335,12 @@ class Sim:
         if self.last_order is None:
             return
 
-        executed_price = None
-
-        if self.last_order.side == 'BID' and self.last_order.price > self.best_ask:
-            executed_price = self.best_ask
-        elif self.last_order.side == 'ASK' and self.last_order.price < self.best_bid:
-            executed_price = self.best_bid
+        sign = self.last_order.side_sign
+        # best price on the opposite side of the book
+        opposite_best = self.best_ask if sign == 1 else self.best_bid
 
-        if executed_price is not None:
+        if sign * (self.last_order.price - opposite_best) > 0:
+            executed_price = opposite_best
             if self.last_order.type != 'POST_ONLY':
                 execute = 'BOOK'
                 trade_type = 'TAKER'
@@ -175,49 +357,52 @@ class Sim:
                     execute)
                 self.strategy_updates_queue.push(own_trade.receive_ts, own_trade)
         else:
-            self.ready_to_execute_orders[self.last_order.order_id] = self.last_order
+            self.add_ready_order(self.last_order)
 
         # delete last order
         self.last_order = None
 
     def execute_orders(self) -> None:
-        executed_orders_id = []
-        for order_id, order in self.ready_to_execute_orders.items():
-            executed_price, execute = None, None
-
-            if order.side == 'BID' and order.price > self.best_ask:
-                executed_price = order.price
-                execute = 'BOOK'
-            elif order.side == 'ASK' and order.price < self.best_bid:
-                executed_price = order.price
-                execute = 'BOOK'
-            elif order.side == 'BID' and order.price > self.trade_price['ASK']:
-                executed_price = order.price
-                execute = 'TRADE'
-            elif order.side == 'ASK' and order.price < self.trade_price['BID']:
-                executed_price = order.price
-                execute = 'TRADE'
-
-            if executed_price is not None:
-                trade_type = 'MAKER'
-                executed_order = OwnTrade(
-                    order.place_ts,  # when we place the order
-                    self.md.exchange_ts,  # exchange ts
-                    self.md.exchange_ts + self.md_latency,  # receive ts
-                    self.get_trade_id(),  # trade id
-                    order_id,
-                    order.side,
-                    order.size,
-                    executed_price,
-                    trade_type,
-                    execute)
-                executed_orders_id.append(order_id)
-                # add order to strategy update queue
-                self.strategy_updates_queue.push(executed_order.receive_ts, executed_order)
-
-        # deleting executed orders
-        for k in executed_orders_id:
-            self.ready_to_execute_orders.pop(k)
+        """
+            Executes ready orders, must be called right after `update_md`.
+        """
+        trade_bid, trade_ask = self.get_last_trade()
+        # no order can cross the current prices, so there is nothing to match
+        if self._bid_bound <= min(self.best_ask, trade_ask) and \
+                self._ask_bound >= max(self.best_bid, trade_bid):
+            return
+        n_executed, self._bid_bound, self._ask_bound = _match_orders(
+            self._orders_side, self._orders_price, self._orders_active, self._orders_count,
+            self.best_bid, self.best_ask, trade_bid, trade_ask,
+            self._executed_slots, self._executed_how)
+
+        executed = list(zip(self._executed_slots[:n_executed].tolist(),
+                            self._executed_how[:n_executed].tolist()))
+        if n_executed > 1:
+            # slots are reused, so restore the order in which the orders were placed
+            executed.sort(key=lambda x: self._orders[x[0]].order_id)
+
+        for slot, how in executed:
+            order = self._orders[slot]
+            self._orders[slot] = None
+            self._free_slots.append(slot)
+            self.ready_to_execute_orders.pop(order.order_id)
+            self._order_slots.pop(order.order_id)
+
+            trade_type = 'MAKER'
+            executed_order = OwnTrade(
+                order.place_ts,  # when we place the order
+                self.md.exchange_ts,  # exchange ts
+                self.md.exchange_ts + self.md_latency,  # receive ts
+                self.get_trade_id(),  # trade id
+                order.order_id,
+                order.side,
+                order.size,
+                order.price,  # executed price
+                trade_type,
+                EXECUTE_NAMES[how])
+            # add order to strategy update queue
+            self.strategy_updates_queue.push(executed_order.receive_ts, executed_order)
 
     def place_order(self, ts: float, size: float, side: str,
                     price: float, order_type: str = 'LIMIT') -> Order:
@@ -5,6 +5,7 @@ import pandas as pd
 from tqdm.auto import tqdm
 
 from .simulator import MdUpdate, Order, OwnTrade, Sim, update_best_positions
+from .utils import KIND_MD_UPDATE, KIND_OWN_TRADE
 
 
 class BestPosStrategy:
@@ -65,10 +66,10 @@ class BestPosStrategy:
             updates_list += updates
             for update in updates:
                 #update best position
-                if isinstance(update, MdUpdate):
+                if update.kind == KIND_MD_UPDATE:
                     best_bid, best_ask = update_best_positions(best_bid, best_ask, update)
                     md_list.append(update)
-                elif isinstance(update, OwnTrade):
+                elif update.kind == KIND_OWN_TRADE:
                     trades_list.append(update)
                     #delete executed trades from the dict
                     if update.order_id in ongoing_orders.keys():
@@ -1,18 +1,31 @@
-from dataclasses import dataclass
-from typing import List, Optional, Tuple
+import gc
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from heapq import heappush, heappop
+from itertools import count
+from typing import ClassVar, Dict, List, Optional, Tuple, Union
 
 import numpy as np
-from sortedcontainers import SortedDict
+import pandas as pd
 
 __all__ = [
+    'KIND_MD_UPDATE', 'KIND_OWN_TRADE', 'KIND_ORDER', 'KIND_CANCEL_ORDER',
     'Order', 'CancelOrder', 'MarketOrder', 'AnonTrade', 'OwnTrade',
-    'OrderbookSnapshotUpdate', 'MdUpdate', 'update_best_positions',
-    'get_mid_price', 'PriorQueue'
+    'OrderbookSnapshotUpdate', 'MdUpdate', 'gc_paused', 'levels_to_tuples', 'MarketDataSoA',
+    'update_best_positions',
+    'updates_to_arrays', 'accumulate_best_positions', 'get_mid_price', 'PriorQueue'
 ]
 
+# type tags of updates and actions, `update.kind` is checked instead of isinstance
+KIND_MD_UPDATE = 0
+KIND_OWN_TRADE = 1
+KIND_ORDER = 2
+KIND_CANCEL_ORDER = 3
 
-@dataclass
+
+@dataclass(slots=True)
 class Order:  # Our own placed order
+    kind: ClassVar[int] = KIND_ORDER
     place_ts: float  # ts when we place the order
     exchange_ts: float  # ts when exchange(simulator) get the order
     order_id: int
@@ -20,12 +33,15 @@ class Order:  # Our own placed order
     size: float
     price: float
     type: str  # 'LIMIT' or 'POST_ONLY'
+    side_sign: int = field(init=False)  # 1 for BID, -1 for ASK
 
     def __post_init__(self):
         assert self.type == 'LIMIT' or self.type == 'POST_ONLY'
+        assert self.side == 'BID' or self.side == 'ASK'
+        self.side_sign = 1 if self.side == 'BID' else -1
 
 
-@dataclass
+@dataclass(slots=True)
 class MarketOrder:  # Our own placed order
     place_ts : float # ts when we place the order
     exchange_ts : float # ts when exchange(simulator) get the order
@@ -34,23 +50,30 @@ class MarketOrder:  # Our own placed order
     size: float
 
 
-@dataclass
+@dataclass(slots=True)
 class CancelOrder:
+    kind: ClassVar[int] = KIND_CANCEL_ORDER
     exchange_ts: float
     id_to_delete: int
 
 
-@dataclass
+@dataclass(slots=True)
 class AnonTrade:  # Market trade
     exchange_ts: float
     receive_ts: float
     side: str
     size: float
     price: float
+    side_sign: int = field(init=False)  # 1 for BID, -1 for ASK
 
+    def __post_init__(self):
+        assert self.side == 'BID' or self.side == 'ASK', "WRONG TRADE SIDE"
+        self.side_sign = 1 if self.side == 'BID' else -1
 
-@dataclass
+
+@dataclass(slots=True)
 class OwnTrade:  # Execution of own placed order
+    kind: ClassVar[int] = KIND_OWN_TRADE
     place_ts: float  # ts when we call place_order method, for debugging
     exchange_ts: float
     receive_ts: float
@@ -61,42 +84,204 @@ class OwnTrade:  # Execution of own placed order
     price: float
     type: str  # type of executed trade: `MAKER` or `TAKER`
     execute: str  # BOOK or TRADE
+    side_sign: int = field(init=False)  # 1 for BID, -1 for ASK
 
     def __post_init__(self):
         assert self.type == 'MAKER' or self.type == 'TAKER'
+        assert self.side == 'BID' or self.side == 'ASK'
+        self.side_sign = 1 if self.side == 'BID' else -1
 
 
-@dataclass
+@dataclass(slots=True)
 class OrderbookSnapshotUpdate:  # Orderbook tick snapshot
     exchange_ts: float
     receive_ts: float
     asks: List[Tuple[float, float]]  # tuple[price, size]
     bids: List[Tuple[float, float]]
+    # prices of the first levels, computed once instead of on every lookup
+    best_bid: float = field(init=False)
+    best_ask: float = field(init=False)
 
+    def __post_init__(self):
+        self.best_bid = self.bids[0][0] if self.bids else np.nan
+        self.best_ask = self.asks[0][0] if self.asks else np.nan
 
-@dataclass
+
+@dataclass(slots=True)
 class MdUpdate:  # Data of a tick
+    kind: ClassVar[int] = KIND_MD_UPDATE
     exchange_ts: float
     receive_ts: float
     orderbook: Optional[OrderbookSnapshotUpdate] = None
     trade: Optional[AnonTrade] = None
 
 
+@contextmanager
+def gc_paused():
+    """Pauses the cyclic garbage collector while millions of market data objects
+        are built. They have no reference cycles, but every collection traverses
+        all of them again, which takes most of the loading time.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def levels_to_tuples(price: np.ndarray, vol: np.ndarray) -> List[List[Tuple[float, float]]]:
+    """Converts arrays of shape (N, levels) to `(price, vol)` levels of N snapshots.
+        A structured array is converted by a single `tolist()` call straight to
+        tuples, without temporary lists of prices and volumes.
+    """
+    levels = np.empty(price.shape, dtype=[('price', np.float64), ('vol', np.float64)])
+    levels['price'] = price
+    levels['vol'] = vol
+    return levels.tolist()
+
+
+@dataclass
+class MarketDataSoA:  # Market data stored as arrays, one row per tick
+    exchange_ts: np.ndarray  # int64
+    receive_ts: np.ndarray  # int64
+    has_book: np.ndarray  # whether the tick contains orderbook snapshot
+    # shapes: (N, levels), NaN if the tick has no snapshot
+    ask_price: np.ndarray
+    ask_vol: np.ndarray
+    bid_price: np.ndarray
+    bid_vol: np.ndarray
+    trade_side: np.ndarray  # int8: 1 for BID, -1 for ASK, 0 if the tick has no trade
+    trade_size: np.ndarray
+    trade_price: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.exchange_ts)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """Same as `updates_to_arrays`, market data fields only."""
+        if self.bid_price.shape[1] > 0:
+            book_bid, book_ask = self.bid_price[:, 0], self.ask_price[:, 0]
+        else:  # no levels, e.g. trades only
+            book_bid, book_ask = np.full(len(self), np.nan), np.full(len(self), np.nan)
+        return {"exchange_ts": self.exchange_ts, "receive_ts": self.receive_ts,
+                "is_book": self.has_book,
+                "book_bid": book_bid, "book_ask": book_ask,
+                "md_trade_side": self.trade_side, "md_trade_price": self.trade_price}
+
+    def to_md_updates(self) -> List[MdUpdate]:
+        """Converts arrays to the list of `MdUpdate` consumed by the simulator."""
+        exchange_ts = self.exchange_ts.tolist()
+        receive_ts = self.receive_ts.tolist()
+        has_book = self.has_book.tolist()
+        trade_side = self.trade_side.tolist()
+        trade_size, trade_price = self.trade_size.tolist(), self.trade_price.tolist()
+
+        with gc_paused():
+            # levels are converted only for the ticks with snapshots, other rows are NaN
+            asks = iter(levels_to_tuples(self.ask_price[self.has_book], self.ask_vol[self.has_book]))
+            bids = iter(levels_to_tuples(self.bid_price[self.has_book], self.bid_vol[self.has_book]))
+
+            md = []
+            for i in range(len(exchange_ts)):
+                book, trade = None, None
+                if has_book[i]:
+                    book = OrderbookSnapshotUpdate(exchange_ts[i], receive_ts[i], next(asks), next(bids))
+                if trade_side[i] != 0:
+                    side = 'BID' if trade_side[i] == 1 else 'ASK'
+                    trade = AnonTrade(exchange_ts[i], receive_ts[i], side, trade_size[i], trade_price[i])
+                md.append(MdUpdate(exchange_ts[i], receive_ts[i], book, trade))
+        return md
+
+
 def update_best_positions(best_bid: float, best_ask: float, md: MdUpdate) -> Tuple[float, float]:
     if md.orderbook is not None:
-        best_bid = md.orderbook.bids[0][0]
-        best_ask = md.orderbook.asks[0][0]
+        best_bid = md.orderbook.best_bid
+        best_ask = md.orderbook.best_ask
     elif md.trade is not None:
-        if md.trade.side == 'BID':
+        if md.trade.side_sign == 1:
             best_ask = max(md.trade.price, best_ask)
-        elif md.trade.side == 'ASK':
-            best_bid = min(best_bid, md.trade.price)
         else:
-            assert False, "WRONG TRADE SIDE"
+            best_bid = min(best_bid, md.trade.price)
     assert best_ask > best_bid, "wrong best positions"
     return best_bid, best_ask
 
 
+def updates_to_arrays(updates_list: List[Union[MdUpdate, OwnTrade]]) -> Dict[str, np.ndarray]:
+    """Extract the fields of updates into flat numpy arrays in a single pass.
+    Args:
+        updates_list: list of updates as returned by the strategy.
+    Returns:
+        Dict of arrays of length `len(updates_list)`. Fields which are not
+        defined for the update (e.g. trade price for market data) are left
+        as zeros.
+    """
+    N = len(updates_list)
+    exchange_ts = np.zeros((N,), dtype=np.int64)
+    receive_ts = np.zeros((N,), dtype=np.int64)
+    # orderbook snapshots
+    is_book = np.zeros((N,), dtype=bool)
+    book_bid = np.zeros((N,))
+    book_ask = np.zeros((N,))
+    # anonymous market trades
+    md_trade_side = np.zeros((N,), dtype=np.int8)
+    md_trade_price = np.zeros((N,))
+    # own trades
+    is_maker = np.zeros((N,), dtype=bool)
+    side_sign = np.zeros((N,), dtype=np.int8)
+    trade_size = np.zeros((N,))
+    trade_price = np.zeros((N,))
+
+    for i, update in enumerate(updates_list):
+        exchange_ts[i] = update.exchange_ts
+        receive_ts[i] = update.receive_ts
+        kind = update.kind
+        if kind == KIND_MD_UPDATE:
+            if update.orderbook is not None:
+                is_book[i] = True
+                book_bid[i] = update.orderbook.best_bid
+                book_ask[i] = update.orderbook.best_ask
+            if update.trade is not None:
+                md_trade_side[i] = update.trade.side_sign
+                md_trade_price[i] = update.trade.price
+        elif kind == KIND_OWN_TRADE:
+            is_maker[i] = update.type == 'MAKER'
+            side_sign[i] = update.side_sign
+            trade_size[i] = update.size
+            trade_price[i] = update.price
+
+    return {"exchange_ts": exchange_ts, "receive_ts": receive_ts,
+            "is_book": is_book, "book_bid": book_bid, "book_ask": book_ask,
+            "md_trade_side": md_trade_side, "md_trade_price": md_trade_price,
+            "is_maker": is_maker, "side_sign": side_sign,
+            "trade_size": trade_size, "trade_price": trade_price}
+
+
+def accumulate_best_positions(arrays: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized version of successive `update_best_positions` calls
+    over the arrays returned by `updates_to_arrays`.
+    Orderbook snapshot resets best positions, market trades between two
+    snapshots can only move them away from each other, so best ask (bid) is
+    a running max (min) within each segment started by a snapshot.
+    """
+    is_book = arrays["is_book"]
+    # segment id: number of snapshots seen so far
+    segment = np.cumsum(is_book)
+
+    ask = np.where(is_book, arrays["book_ask"],
+                   np.where(arrays["md_trade_side"] == 1, arrays["md_trade_price"], -np.inf))
+    bid = np.where(is_book, arrays["book_bid"],
+                   np.where(arrays["md_trade_side"] == -1, arrays["md_trade_price"], np.inf))
+    best_ask = pd.Series(ask).groupby(segment).cummax().to_numpy()
+    best_bid = pd.Series(bid).groupby(segment).cummin().to_numpy()
+    # before the first snapshot nothing is known about the book
+    best_ask = np.where(segment == 0, np.inf, best_ask)
+    best_bid = np.where(segment == 0, -np.inf, best_bid)
+    assert np.all(best_ask > best_bid), "wrong best positions"
+    return best_bid, best_ask
+
+
 def get_mid_price(mid_price: float, md: MdUpdate):
     book = md.orderbook
     if book is None:
@@ -115,24 +300,25 @@ def get_mid_price(mid_price: float, md: MdUpdate):
 
 
 class PriorQueue:
+    """Priority queue which pops all the values with the minimal key at once.
+    Values with equal keys are popped in the order they were pushed.
+    """
     def __init__(self, default_key=np.inf, default_val=None):
-        self._queue = SortedDict()
-        self._min_key = np.inf
+        # heap of (key, push counter, value)
+        self._heap = []
+        self._counter = count()
 
     def push(self, key, val):
-        if key not in self._queue:
-            self._queue[key] = []
-        self._queue[key].append(val)
-        self._min_key = min(self._min_key, key)
+        heappush(self._heap, (key, next(self._counter), val))
 
     def pop(self):
-        if len(self._queue) == 0:
+        if not self._heap:
             return np.inf, None
-        res = self._queue.popitem(0)
-        self._min_key = np.inf
-        if len(self._queue):
-            self._min_key = self._queue.peekitem(0)[0]
-        return res
+        key, _, val = heappop(self._heap)
+        res = [val]
+        while self._heap and self._heap[0][0] == key:
+            res.append(heappop(self._heap)[2])
+        return key, res
 
     def min_key(self):
-        return self._min_key
+        return self._heap[0][0] if self._heap else np.inf
@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from simulator import load_data
+from simulator.load_data import load_trades_arrays
+
+
+@pytest.fixture
+def trades_path(tmp_path):
+    # more than one 100k-row chunk, the last chunk contains only BID trades
+    n = 100_003
+    ts = 1_655_942_400_000_000_000 + np.arange(n) * 1000
+    side = np.where(np.arange(n) % 2 == 0, 'BID', 'ASK')
+    side[-3:] = 'BID'
+    path = tmp_path / 'trades.csv'
+    pd.DataFrame({'receive_ts': ts, 'exchange_ts': ts, 'price': 20000.0,
+                  'size': 0.001, 'aggro_side': side}).to_csv(path, index=False)
+    return path, ts, side
+
+
+@pytest.mark.parametrize('use_pyarrow', [True, False])
+def test_trade_side_of_several_chunks(trades_path, use_pyarrow, monkeypatch):
+    path, ts, side = trades_path
+    if not use_pyarrow:
+        monkeypatch.setattr(load_data, 'pacsv', None)
+    elif load_data.pacsv is None:
+        pytest.skip('pyarrow is not installed')
+
+    trades = load_trades_arrays(str(path), min_ts=pd.Timestamp(ts[0]))
+    assert len(trades) == len(ts)
+    np.testing.assert_array_equal(trades.trade_side, np.where(side == 'BID', 1, -1))